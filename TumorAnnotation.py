@@ -7,6 +7,11 @@ import ctk
 import slicer
 from slicer.ScriptedLoadableModule import *
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class TumorAnnotation(ScriptedLoadableModule):
     """Uses ScriptedLoadableModule base class."""
@@ -30,13 +35,34 @@ class TumorAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def __init__(self, parent=None):
         ScriptedLoadableModuleWidget.__init__(self, parent)
+        self.niftiFiles = []
         self.currentFileIndex = 0
-        self.pointCoordinates = []
+        self._pointsArr = np.empty((6, 3), dtype=np.float64)
+        self._nPoints = 0
+        self._extents = None
+        self._boxCenter = None
+        self._volumeBasis = None
+        self._rasToVolumeAxes = None
+        self._rotMat = vtk.vtkMatrix4x4()
+        self._ijkToRas = vtk.vtkMatrix4x4()
+        self._currentVolume = None
+        self._preloaded = {}
         self.boundingBoxNode = None
-        self.boundingBoxModel = None
         self.fiducialNode = None
         self.placementActive = False
 
+        # Coalesce bursts of slider ticks into at most one update per frame
+        self._pendingRelax = 0
+        self._relaxTimer = qt.QTimer()
+        self._relaxTimer.setSingleShot(True)
+        self._relaxTimer.setInterval(16)
+        self._relaxTimer.timeout.connect(self.applyRelaxation)
+
+    @property
+    def pointCoordinates(self):
+        """Placed points as a list of [R, A, S] lists, for serialization"""
+        return self._pointsArr[:self._nPoints].tolist()
+
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
@@ -83,11 +109,11 @@ class TumorAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def updateUI(self):
         """Update UI elements based on current state"""
-        hasFiles = hasattr(self, 'niftiFiles') and len(self.niftiFiles) > 0
+        hasFiles = bool(self.niftiFiles)
         hasLoaded = hasFiles and self.currentFileIndex < len(self.niftiFiles)
         
         self.ui.placePointsButton.enabled = hasLoaded
-        self.ui.createBBoxButton.enabled = hasLoaded and (hasattr(self, 'fiducialNode') and self.fiducialNode.GetNumberOfControlPoints() >= 6)
+        self.ui.createBBoxButton.enabled = hasLoaded and self.fiducialNode is not None and self.fiducialNode.GetNumberOfControlPoints() >= 6
         self.ui.relaxSlider.enabled = hasLoaded and self.boundingBoxNode is not None
         self.ui.submitButton.enabled = hasLoaded and self.boundingBoxNode is not None
         self.ui.nextButton.enabled = hasFiles and self.currentFileIndex < len(self.niftiFiles) - 1
@@ -98,9 +124,9 @@ class TumorAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def onDirectoryChanged(self):
         """Called when directory is changed"""
-        if hasattr(self, 'niftiFiles'):
-            del self.niftiFiles
+        self.niftiFiles = []
         self.currentFileIndex = 0
+        self.clearPreloaded()
         self.clearAnnotation()
         self.updateUI()
 
@@ -111,10 +137,13 @@ class TumorAnnotationWidget(ScriptedLoadableModuleWidget):
             slicer.util.errorDisplay("Please select a directory first")
             return
 
-        self.niftiFiles = [f for f in os.listdir(directory) 
-                         if f.lower().endswith('.nii') or f.lower().endswith('.nii.gz')]
-        self.niftiFiles.sort()
+        with os.scandir(directory) as entries:
+            self.niftiFiles = sorted(
+                e.name for e in entries
+                if e.is_file()
+                and e.name.lower().endswith(('.nii', '.nii.gz')))
         self.currentFileIndex = 0
+        self.clearPreloaded()
         
         if not self.niftiFiles:
             slicer.util.errorDisplay("No NIfTI files found in selected directory")
@@ -125,127 +154,179 @@ class TumorAnnotationWidget(ScriptedLoadableModuleWidget):
 
     def loadCurrentFile(self):
         """Load the current NIfTI file"""
-        if not hasattr(self, 'niftiFiles') or self.currentFileIndex >= len(self.niftiFiles):
+        if self.currentFileIndex >= len(self.niftiFiles):
             return
             
-        self.clearAnnotation()
+        # Render once after the old annotation is cleared and the new volume is shown
+        slicer.app.pauseRender()
+        try:
+            self.clearAnnotation()
+
+            # Load new volume, reusing the prefetched node when available
+            filePath = os.path.join(self.ui.directoryButton.directory,
+                                    self.niftiFiles[self.currentFileIndex])
+            volumeNode = self._preloaded.pop(filePath, None)
+            if volumeNode is not None:
+                slicer.util.setSliceViewerLayers(background=volumeNode, fit=True)
+            else:
+                volumeNode = slicer.util.loadVolume(filePath)
+            self._currentVolume = volumeNode
+
+            # Cache the volume's normalized axis directions (columns of IJK to RAS)
+            volumeNode.GetIJKToRASMatrix(self._ijkToRas)
+            basis = slicer.util.arrayFromVTKMatrix(self._ijkToRas)[:3, :3].copy()
+            basis /= np.linalg.norm(basis, axis=0, keepdims=True)
+            self._volumeBasis = basis
+            self._rasToVolumeAxes = np.linalg.inv(basis)
+
+            # Start in placement mode automatically
+            self.enterPlacementMode()
+        finally:
+            slicer.app.resumeRender()
+
+    def prefetchNextFile(self):
+        """Load the next NIfTI file hidden so that "Next" can show it immediately"""
+        nextIndex = self.currentFileIndex + 1
+        if nextIndex >= len(self.niftiFiles):
+            return
 
-        # Load new volume
-        filePath = os.path.join(self.ui.directoryButton.directory, 
-                              self.niftiFiles[self.currentFileIndex])
-        slicer.util.loadVolume(filePath)
-        
-        # Start in placement mode automatically
-        self.enterPlacementMode()
+        filePath = os.path.join(self.ui.directoryButton.directory, self.niftiFiles[nextIndex])
+        # Only keep the upcoming file around to bound memory
+        for stalePath in [path for path in self._preloaded if path != filePath]:
+            slicer.mrmlScene.RemoveNode(self._preloaded.pop(stalePath))
+        if filePath in self._preloaded:
+            return
+
+        self._preloaded[filePath] = slicer.util.loadVolume(filePath, properties={'show': False})
+
+    def clearPreloaded(self):
+        """Remove prefetched volumes that have not been shown yet"""
+        for volumeNode in self._preloaded.values():
+            slicer.mrmlScene.RemoveNode(volumeNode)
+        self._preloaded = {}
 
     def clearAnnotation(self):
         """Clear current annotation"""
-        self.pointCoordinates = []
-        if hasattr(self, 'fiducialNode') and self.fiducialNode:
-            slicer.mrmlScene.RemoveNode(self.fiducialNode)
-            self.fiducialNode = None
-        if self.boundingBoxNode:
-            slicer.mrmlScene.RemoveNode(self.boundingBoxNode)
-            self.boundingBoxNode = None
-        if self.boundingBoxModel:
-            slicer.mrmlScene.RemoveNode(self.boundingBoxModel)
-            self.boundingBoxModel = None
+        self._nPoints = 0
+        self._extents = None
+        self._boxCenter = None
+        # Remove nodes in batch mode so the scene only updates once
+        slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+        try:
+            if self.fiducialNode:
+                slicer.mrmlScene.RemoveNode(self.fiducialNode)
+                self.fiducialNode = None
+            if self.boundingBoxNode:
+                slicer.mrmlScene.RemoveNode(self.boundingBoxNode)
+                self.boundingBoxNode = None
+            if self._currentVolume:
+                slicer.mrmlScene.RemoveNode(self._currentVolume)
+                self._currentVolume = None
+                self._volumeBasis = None
+                self._rasToVolumeAxes = None
+        finally:
+            slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
 
     def onPointPlaced(self, caller, event):
         """Handle new point placement"""
-        if self.fiducialNode.GetNumberOfControlPoints() <= 6:
-            pointPos = [0, 0, 0]
-            self.fiducialNode.GetNthControlPointPosition(
-                self.fiducialNode.GetNumberOfControlPoints()-1, pointPos)
-            self.pointCoordinates.append(pointPos.copy())
+        numberOfPoints = self.fiducialNode.GetNumberOfControlPoints()
+        if self._nPoints < 6 and numberOfPoints <= 6:
+            pos = self.fiducialNode.GetNthControlPointPositionVector(numberOfPoints-1)
+            pointPos = (pos[0], pos[1], pos[2])
+            self._pointsArr[self._nPoints] = pointPos
+            self._nPoints += 1
         
         self.updateUI()
 
     def onCreateBBoxButtonClicked(self):
         """Create bounding box from placed points, aligned with the volume's axes"""
-        if not hasattr(self, 'fiducialNode') or self.fiducialNode.GetNumberOfControlPoints() < 6:  # Fixed typo here
+        if self.fiducialNode is None or self.fiducialNode.GetNumberOfControlPoints() < 6:
             slicer.util.errorDisplay("Please place all 6 points first")
             return
 
-        # Get current volume node
-        volumeNode = slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetBackgroundLayer().GetVolumeNode()
-        if not volumeNode:
+        # Volume and its orientation are cached in loadCurrentFile
+        if self._currentVolume is None:
             slicer.util.errorDisplay("No volume loaded")
             return
 
-        # Get volume's IJK to RAS matrix
-        ijkToRas = vtk.vtkMatrix4x4()
-        volumeNode.GetIJKToRASMatrix(ijkToRas)
-
-        # Convert points to numpy array
-        points = np.array(self.pointCoordinates)
-
-        # Compute axis-aligned bounding box in RAS coordinates
-        minCoords = np.min(points, axis=0)
-        maxCoords = np.max(points, axis=0)
-
-        # Optional: relax the box
-        relaxation = self.ui.relaxSlider.value
-        minCoords -= relaxation
-        maxCoords += relaxation
-
-        center = (minCoords + maxCoords) / 2
-        size = maxCoords - minCoords
-
-        # Create ROI node
-        self.boundingBoxNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsROINode', 'BoundingBox')
-        self.boundingBoxNode.CreateDefaultDisplayNodes()
-        self.boundingBoxNode.GetDisplayNode().SetColor(0, 1, 0)  # Green
-        
-        # First set the center and size in RAS coordinates
-        self.boundingBoxNode.SetCenter(center)
-        self.boundingBoxNode.SetSize(size)
-
-        # Now align with volume axes
-        # Get the volume's orientation vectors (columns of the rotation matrix)
-        x_vector = np.array([ijkToRas.GetElement(0,0), ijkToRas.GetElement(1,0), ijkToRas.GetElement(2,0)])
-        y_vector = np.array([ijkToRas.GetElement(0,1), ijkToRas.GetElement(1,1), ijkToRas.GetElement(2,1)])
-        z_vector = np.array([ijkToRas.GetElement(0,2), ijkToRas.GetElement(1,2), ijkToRas.GetElement(2,2)])
-
-        # Normalize the vectors
-        x_vector = x_vector / np.linalg.norm(x_vector)
-        y_vector = y_vector / np.linalg.norm(y_vector)
-        z_vector = z_vector / np.linalg.norm(z_vector)
-
-        # Create rotation matrix that aligns with volume axes
-        rotationMatrix = vtk.vtkMatrix4x4()
-        for i in range(3):
-            rotationMatrix.SetElement(i, 0, x_vector[i])
-            rotationMatrix.SetElement(i, 1, y_vector[i])
-            rotationMatrix.SetElement(i, 2, z_vector[i])
-            rotationMatrix.SetElement(i, 3, center[i])  # Set translation component
-        
-        # The rotation matrix should include the translation to keep the box centered
-        rotationMatrix.SetElement(3, 3, 1)  # Homogeneous coordinate
+        # Re-read the first 6 control points so deleted or dragged points are picked up
+        controlPoints = slicer.util.arrayFromMarkupsControlPoints(self.fiducialNode)[:6]
+        self._nPoints = len(controlPoints)
+        self._pointsArr[:self._nPoints] = controlPoints
+
+        # Take the extents along the volume axes so the rotated box stays tight,
+        # then map the center back to RAS. Cached for the relax slider.
+        points = self._pointsArr[:self._nPoints] @ self._rasToVolumeAxes.T
+        minCoords = points.min(axis=0)
+        maxCoords = points.max(axis=0)
+        self._extents = (tuple(minCoords), tuple(maxCoords))
+        self._boxCenter = tuple(self._volumeBasis @ ((minCoords + maxCoords) / 2))
+
+        # Optionally relax the box
+        center, size = self.computeBox(self.ui.relaxSlider.value)
+
+        # Render once after the box is created and placement mode is restored
+        slicer.app.pauseRender()
+        try:
+            # Create ROI node
+            self.boundingBoxNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsROINode', 'BoundingBox')
+            self.boundingBoxNode.CreateDefaultDisplayNodes()
+            displayNode = self.boundingBoxNode.GetDisplayNode()
+            wasDisplayModifying = displayNode.StartModify()
+            displayNode.SetColor(0, 1, 0)  # Green
+            displayNode.SetFillOpacity(0.3)
+            displayNode.EndModify(wasDisplayModifying)
+
+            # Collapse all property changes below into a single ModifiedEvent
+            wasModifying = self.boundingBoxNode.StartModify()
+
+            # First set the center in RAS and the size along the volume axes
+            self.boundingBoxNode.SetCenter(center)
+            self.boundingBoxNode.SetSize(size)
+
+            # Now align with volume axes using the cached normalized basis
+            basis = self._volumeBasis
+
+            # Fill the reused rotation matrix that aligns with volume axes;
+            # Identity() takes care of the homogeneous bottom row
+            rotationMatrix = self._rotMat
+            rotationMatrix.Identity()
+            for i in range(3):
+                for j in range(3):
+                    rotationMatrix.SetElement(i, j, basis[i, j])
+                rotationMatrix.SetElement(i, 3, center[i])  # Set translation component
+
+            # Copy into the node's own matrix so later reuse of _rotMat doesn't alias it
+            self.boundingBoxNode.GetObjectToNodeMatrix().DeepCopy(rotationMatrix)
+            self.boundingBoxNode.Modified()
+            self.boundingBoxNode.EndModify(wasModifying)
 
-        # Apply the transformation to the bounding box
-        self.boundingBoxNode.GetObjectToNodeMatrix().DeepCopy(rotationMatrix)
-        self.boundingBoxNode.Modified()
+            self.updateUI()
 
-        self.updateUI()
+            # Go back placement mode
+            self.enterPlacementMode()
+        finally:
+            slicer.app.resumeRender()
 
-        # Go back placement mode
-        self.enterPlacementMode()
+    def computeBox(self, relaxation):
+        """Return (center, size) of the placed points' box grown by relaxation on each side"""
+        minCoords, maxCoords = self._extents
+        size = tuple((hi - lo) + 2 * relaxation for lo, hi in zip(minCoords, maxCoords))
+        return self._boxCenter, size
 
     def onRelaxSliderChanged(self, value):
+        """Schedule a bounding box update for the new relaxation value"""
+        self._pendingRelax = value
+        self._relaxTimer.start()
+
+    def applyRelaxation(self):
         """Adjust bounding box size while maintaining orientation"""
-        if not self.boundingBoxNode or len(self.pointCoordinates) < 6:
+        if not self.boundingBoxNode or self._extents is None or self._nPoints < 6:
             return
 
-        points = np.array(self.pointCoordinates)
-        minCoords = np.min(points, axis=0)
-        maxCoords = np.max(points, axis=0)
-
-        minCoords -= value
-        maxCoords += value
+        center, size = self.computeBox(self._pendingRelax)
 
-        center = (minCoords + maxCoords) / 2
-        size = maxCoords - minCoords
+        wasModifying = self.boundingBoxNode.StartModify()
 
         # Get current transform
         transformNode = self.boundingBoxNode.GetParentTransformNode()
@@ -260,16 +341,22 @@ class TumorAnnotationWidget(ScriptedLoadableModuleWidget):
             transformNode.SetMatrixTransformToParent(transformMatrix)
 
         self.boundingBoxNode.SetSize(size)
+        self.boundingBoxNode.EndModify(wasModifying)
 
         # Go back placement mode
         self.enterPlacementMode()
 
     def onSubmitButtonClicked(self):
         """Save the annotation data to JSON"""
-        if not self.boundingBoxNode or len(self.pointCoordinates) < 6:
+        if not self.boundingBoxNode or self._nPoints < 6:
             slicer.util.errorDisplay("Please create a bounding box first")
             return
-            
+
+        # Flush a pending slider update so the saved box matches the slider
+        if self._relaxTimer.isActive():
+            self._relaxTimer.stop()
+            self.applyRelaxation()
+
         data = {
             "filename": self.niftiFiles[self.currentFileIndex],
             "points": self.pointCoordinates,
@@ -292,11 +379,19 @@ class TumorAnnotationWidget(ScriptedLoadableModuleWidget):
             outputDir, 
             os.path.splitext(self.niftiFiles[self.currentFileIndex])[0] + ".json")
         
-        with open(outputPath, 'w') as f:
-            json.dump(data, f, indent=2)
+        if orjson is not None:
+            payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        else:
+            payload = json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+        with open(outputPath, 'wb') as f:
+            f.write(payload)
             
         slicer.util.infoDisplay(f"Annotation saved to {outputPath}")
 
+        # The annotation is done, so read the next file while the user is idle
+        qt.QTimer.singleShot(0, self.prefetchNextFile)
+
     def onNextButtonClicked(self):
         """Move to next sample"""
         if self.currentFileIndex < len(self.niftiFiles) - 1: